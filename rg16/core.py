@@ -11,10 +11,17 @@ understanding Base Scan intervals, data format, and sensor type numbers
 can be found here: https://imgur.com/a/4aneG
 """
 
+import collections
+import copy
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from obspy.core import Stream, Trace, Stats, UTCDateTime
+from obspy.core import Stream, Stats, UTCDateTime
 
-from rg16.utils import read, open_file, read_block, quick_merge
+from rg16.utils import (read_struct, open_file, open_buffer, compile_block,
+                        read_block_array, block_dtype, is_bcd, quick_merge,
+                        iter_quick_merge, make_trace)
 
 
 # --------------------- define specs of needed blocks
@@ -68,17 +75,52 @@ trace_header_block = [
     ('time', 20 + 2 * 32, 8, '>i8'),
 ]
 
-# since UTCDateTime cannot be compared to np.inf in py27 get a large timestamp
-# after which I will be dead (somebody else's problem)
-BIG_TS = UTCDateTime('3000-01-01').timestamp
+# the fields needed to find each trace and whether it is in the requested
+# time window are decoded for every trace, the rest only for kept traces
+TRACE_POSITION_NAMES = {'trace_number', 'num_ext_blocks', 'samples', 'time'}
+trace_position_block = [x for x in trace_header_block
+                        if x[0] in TRACE_POSITION_NAMES]
+trace_detail_block = [x for x in trace_header_block
+                      if x[0] not in TRACE_POSITION_NAMES]
+
+# the number of bytes of the trace header block that are read, and the
+# (start, length) of each field for decoding fields directly
+TRACE_HEADER_SIZE = block_dtype(trace_header_block).itemsize
+TRACE_HEADER_FIELDS = {x[0]: (x[1], x[2]) for x in trace_header_block}
+
+# the number of bytes of equal length traces to convert into native floats
+# at once, this bounds the memory held when iterating over traces
+DATA_CHUNK_BYTES = 16 * 1024 ** 2
+
+# the number of threads converting chunks of data at once. Each chunk is
+# converted by a single astype, during which numpy releases the GIL, so the
+# chunks of large files are converted in parallel on the cpus this process
+# may run on. With one cpu threads only add overhead so none are started.
+if hasattr(os, 'sched_getaffinity'):
+    DATA_THREADS = min(4, len(os.sched_getaffinity(0)) or 1)
+else:
+    DATA_THREADS = min(4, os.cpu_count() or 1)
+
+# compiled readers for blocks which are read one at a time
+read_general_header = compile_block(general_header_block)
+read_trace_header = compile_block(trace_header_block)
+
+# the sample format (bcd 8058), manufacturer code (bcd 20) and version (1.6)
+# bytes in the first 44 bytes of every rg16 file
+RG16_MAGIC = '>2x2s12xs25x2s'
+RG16_MAGIC_VALUES = (b'\x80\x58', b'\x20', b'\x01\x06')
+
+# the largest time, in ns, trace times are compared to when no endtime is
+# given, nanoseconds since 1970 overflow int64 in 2262 (somebody else's
+# problem)
+BIG_NS = np.iinfo(np.int64).max
 
 
 # ------------------- read and format check functions
 
 
-@open_file
 def read_rg16(fi, headonly=False, starttime=None, endtime=None, merge=False,
-              **kwargs):
+              generator=False, **kwargs):
     """
     Read fairfield nodal's Receiver Gather File Format version 1.6-1.
 
@@ -95,15 +137,62 @@ def read_rg16(fi, headonly=False, starttime=None, endtime=None, merge=False,
         continuous data files having 100,000+ traces this will create
         more manageable streams.
     :type merge: bool
-    :return: An ObsPy :class:`~obspy.core.stream.Stream` object.
+    :param generator:
+        If True return a generator of traces rather than a Stream, so each
+        trace can be processed without holding all of them in memory. The
+        file is kept open until the generator is exhausted or closed. Each
+        trace yielded has its own data array, whereas the data of traces in
+        a Stream may be views of an array shared with neighbouring traces.
+    :type generator: bool
+    :return:
+        An ObsPy :class:`~obspy.core.stream.Stream` object, or a generator
+        of :class:`~obspy.core.trace.Trace` objects if generator is True.
+    """
+    if generator:
+        traces = _iter_rg16(fi, headonly, starttime, endtime)
+        next(traces)  # check now rather than on the first trace
+        return iter_quick_merge(traces) if merge else traces
+    with open_buffer(fi, advise=True) as buf:
+        theaders, sampling_rate = _read_headers(buf, starttime, endtime)
+        # the number of traces is known so fill a list of that size
+        traces = [None] * len(theaders['time'])
+        data = _iter_traces(buf, theaders, sampling_rate, headonly)
+        for write_idx, tr in enumerate(data):
+            traces[write_idx] = tr
+        if merge:
+            traces = quick_merge(traces)
+    return Stream(traces=traces)
+
+
+def _iter_rg16(fi, headonly, starttime, endtime):
+    """
+    Yield the traces of a rg16 file, see read_rg16. None is yielded first,
+    once the file is checked and its headers read, so starting the
+    generator raises for a bad file.
+    """
+    with open_buffer(fi, advise=True) as buf:
+        theaders, sampling_rate = _read_headers(buf, starttime, endtime)
+        yield None
+        # copy the data of each trace so it can outlive the others
+        traces = _iter_traces(buf, theaders, sampling_rate, headonly,
+                              copy=True)
+        for tr in traces:
+            yield tr
+
+
+def _read_headers(fi, starttime, endtime):
+    """
+    Read the headers of a rg16 buffer. Return the header columns of the
+    traces in the time window and the sampling rate.
     """
     if not is_rg16(fi):
-        raise ValueError('read_fcnt was not passed a Fairfield RG 1.6 file')
-    # get timestamps
-    time1 = UTCDateTime(starttime).timestamp if starttime else 0
-    time2 = UTCDateTime(endtime).timestamp if endtime else BIG_TS
+        raise ValueError('read_fcnt was not passed a Fairfield RG 1.6 '
+                         'file')
+    # get the window times in ns
+    time1 = UTCDateTime(starttime).ns if starttime else 0
+    time2 = UTCDateTime(endtime).ns if endtime else BIG_NS
     # read general header information
-    gheader = read_block(fi, general_header_block)
+    gheader = read_general_header(fi)
     # byte number channel sets start at in file
     chan_set_start = (gheader['num_additional_headers'] + 1) * 32
     # get the byte number the extended headers start
@@ -112,10 +201,20 @@ def read_rg16(fi, headonly=False, starttime=None, endtime=None, merge=False,
     ex_headers = gheader['extended_headers'] + gheader['external_headers']
     # get byte number trace headers start
     theader_start = eheader_start + (ex_headers * 32)
-    # get traces and return stream
-    traces = _make_traces(fi, theader_start, gheader, head_only=headonly,
-                          starttime=time1, endtime=time2, merge=merge)
-    return Stream(traces=traces)
+    # get trace headers in the time window
+    sampling_rate = _get_sampling_rate(gheader)
+    theaders = _read_trace_headers(fi, theader_start)
+    # drop the traces outside of the requested time window all at once,
+    # rounding the trace ends to ns the same way Stats.endtime does
+    starts = theaders['time'].astype(np.int64) * 1000  # time is in us
+    timediff = np.maximum(theaders['samples'] - 1, 0) * (1.0 / sampling_rate)
+    ends = starts + np.round(timediff * 1e9).astype(np.int64)
+    in_window = (ends >= time1) & (starts <= time2)
+    theaders = {name: values[in_window] for name, values in theaders.items()}
+    # then decode the rest of the fields of the traces that are left
+    theaders.update(read_block_array(fi, trace_detail_block,
+                                     theaders['position']))
+    return theaders, sampling_rate
 
 
 @open_file
@@ -128,62 +227,256 @@ def is_rg16(fi, **kwargs):
     :return: bool
     """
     try:
-        sample_format = read(fi, 2, 2, 'bcd')
-        manufacturer_code = read(fi, 16, 1, 'bcd')
-        version = read(fi, 42, 2, None)
+        magic = read_struct(fi, 0, RG16_MAGIC)
     except ValueError:  # if file too small
         return False
-    con1 = version == b'\x01\x06' and sample_format == 8058
-    return con1 and manufacturer_code == 20
+    # the bcd values only have one encoding so the raw bytes are compared
+    return magic == RG16_MAGIC_VALUES
 
 
 # ------------ helper functions for formatting specific blocks
 
 
-def _make_traces(fi, data_block_start, gheader, head_only=False,
-                 starttime=None, endtime=None, merge=False):
-    """ make obspy traces from trace blocks and headers """
-    traces = []  # list to store traces
-    trace_position = data_block_start
-    while True:  # read traces until parser falls of the end of file
-        try:
-            theader = read_block(fi, trace_header_block, trace_position)
-        except ValueError:  # this is the end, my only friend, the end
+def _iter_traces(fi, theaders, sampling_rate, head_only=False, copy=False):
+    """
+    Make obspy traces from the trace header columns. If copy each trace
+    gets its own data array rather than a view of a converted chunk.
+    """
+    # make the traces in a single pass over the header columns
+    stats = _iter_stats(theaders, sampling_rate)
+    if head_only:  # empty np array for head only
+        for header in stats:
+            yield make_trace(np.array([]), header)
+        return
+    # else read data straight out of the buffer
+    for header, data in zip(stats, _iter_data(fi, theaders, copy)):
+        yield make_trace(data, header)
+
+
+def _iter_data(fi, theaders, copy=False):
+    """ yield the data of each trace in the trace header columns """
+    data_starts = (theaders['position'] + 20 +
+                   theaders['num_ext_blocks'] * 32)
+    samples = theaders['samples']
+    steps = np.unique(np.diff(data_starts))
+    if len(samples) and np.all(samples == samples[0]) and len(steps) <= 1:
+        # traces of a continuous recording are all the same length and
+        # evenly spaced, so many can be converted in one go
+        data = _iter_constant_length_data(fi, data_starts, int(samples[0]),
+                                          copy)
+    else:
+        data = _iter_variable_length_data(fi, data_starts, samples, copy)
+    for array in data:
+        yield array
+
+
+def _iter_constant_length_data(fi, data_starts, samples, copy=False):
+    """
+    Yield the data of evenly spaced traces with the same number of samples.
+
+    The data of all the traces are viewed as the rows of one 2D array,
+    skipping the headers between them, which is converted to native
+    float32 DATA_CHUNK_BYTES at a time. Each trace gets a row of its chunk,
+    or a copy of the row if copy, so a kept trace does not hold on to the
+    rest of its chunk.
+    """
+    if samples == 0:  # nothing to view, every trace is empty
+        for _ in data_starts:
+            yield np.empty(0, dtype=np.float32)
+        return
+    if len(data_starts) > 1:
+        stride = int(data_starts[1] - data_starts[0])
+    else:
+        stride = samples * 4
+    view = np.ndarray((len(data_starts), samples), dtype='>f4', buffer=fi,
+                      offset=int(data_starts[0]), strides=(stride, 4))
+    rows_per_chunk = max(1, DATA_CHUNK_BYTES // (samples * 4))
+
+    def convert(start):
+        return view[start:start + rows_per_chunk].astype(np.float32)
+
+    chunks = range(0, len(view), rows_per_chunk)
+    for data in _iter_in_threads(convert, chunks):
+        for row in data:
+            yield row.copy() if copy else row
+
+
+def _iter_variable_length_data(fi, data_starts, samples, copy=False):
+    """
+    Yield the data of traces which may not be evenly spaced or of equal
+    length.
+
+    The bytes of the traces are viewed as one 1D array of 4 byte words,
+    as traces and their headers are whole numbers of words. The words
+    spanned by about DATA_CHUNK_BYTES of the file at a time are converted
+    to native float32 in one go, the few header words between the traces
+    included. Each trace gets a slice of its chunk, or a copy of the slice
+    if copy.
+    """
+    if not len(samples):
+        return
+    first = int(np.min(data_starts))
+    end = int(np.max(data_starts + samples * 4))
+    words = np.frombuffer(fi, dtype='>f4', count=(end - first) // 4,
+                          offset=first)
+    # the slice of words holding the samples of each trace
+    word_starts = (data_starts - first) // 4
+    word_ends = word_starts + samples
+
+    def convert(chunk):
+        start = int(np.min(word_starts[chunk]))
+        stop = int(np.max(word_ends[chunk]))
+        return words[start:stop].astype(np.float32), start
+
+    # number the chunks by the byte each trace starts at in the file
+    chunk_numbers = (data_starts - first) // DATA_CHUNK_BYTES
+    boundaries = np.flatnonzero(np.diff(chunk_numbers)) + 1
+    chunks = np.split(np.arange(len(samples)), boundaries)
+    converted = _iter_in_threads(convert, chunks)
+    for (data, offset), chunk in zip(converted, chunks):
+        starts = (word_starts[chunk] - offset).tolist()
+        ends = (word_ends[chunk] - offset).tolist()
+        for start, stop in zip(starts, ends):
+            array = data[start:stop]
+            yield array.copy() if copy else array
+
+
+def _iter_in_threads(func, items):
+    """
+    Yield func(item) for each of items, in order.
+
+    When there is more than one item up to DATA_THREADS items are run ahead
+    in a thread pool, so no more than that many results are held at once.
+    func should spend its time in a few large numpy calls which release the
+    GIL, not in python loops, or the threads only slow it down.
+    """
+    items = list(items)
+    if len(items) <= 1 or DATA_THREADS <= 1:  # not worth starting threads
+        for item in items:
+            yield func(item)
+        return
+    pending = collections.deque()
+    with ThreadPoolExecutor(DATA_THREADS) as executor:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= DATA_THREADS:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _read_trace_headers(fi, data_block_start):
+    """
+    Read the fields of trace_position_block of all the trace headers into
+    a dict of arrays. The byte position of each trace is included under the
+    key 'position'.
+    """
+    theaders = _read_constant_length_headers(fi, data_block_start)
+    if theaders is None:  # trace lengths vary so walk the headers instead
+        positions = _find_trace_positions(fi, data_block_start)
+        theaders = read_block_array(fi, trace_position_block, positions)
+        theaders['position'] = positions
+    return theaders
+
+
+def _read_constant_length_headers(fi, data_block_start):
+    """
+    Read the trace headers assuming every trace has the same length as the
+    first, which is usually the case for continuous recordings. Return None
+    if they do not.
+    """
+    try:
+        first = read_trace_header(fi, data_block_start)
+    except ValueError:  # no traces in the file
+        return None
+    stride = _trace_length(first)
+    count = (len(fi) - data_block_start) // stride
+    positions = data_block_start + np.arange(count) * stride
+    try:
+        theaders = read_block_array(fi, trace_position_block, positions)
+    except ValueError:  # garbage after the last trace
+        return None
+    if not _is_constant_length(theaders, first):
+        return None
+    theaders['position'] = positions
+    return theaders
+
+
+def _find_trace_positions(fi, data_block_start):
+    """
+    Walk the trace headers to get the byte position of each trace.
+
+    Only the fields needed to find the next trace are decoded, straight
+    from the buffer, and walking stops at the first incomplete trace or
+    invalid trace number.
+    """
+    number_start, number_length = TRACE_HEADER_FIELDS['trace_number']
+    ext_start, _ = TRACE_HEADER_FIELDS['num_ext_blocks']
+    samples_start, samples_length = TRACE_HEADER_FIELDS['samples']
+    positions = []
+    position = data_block_start
+    while position + TRACE_HEADER_SIZE <= len(fi):
+        number_chunk = fi[position + number_start:
+                          position + number_start + number_length]
+        if not is_bcd(number_chunk):
+            break
+        samples_chunk = fi[position + samples_start:
+                           position + samples_start + samples_length]
+        samples = int.from_bytes(samples_chunk, 'big')
+        length = 20 + fi[position + ext_start] * 32 + samples * 4
+        if position + length > len(fi):
             break
-        # get stats
-        stats = _make_stats(theader, gheader)
-        # expected jump to next start position
-        jumps = stats.npts * 4 + theader['num_ext_blocks'] * 32 + 20
-        # if wrong starttime / endtime just keep going and update position
-        if stats.endtime < starttime or stats.starttime > endtime:
-            trace_position += jumps
-            continue
-        if head_only:  # empty np array for head only
-            data = np.array([])
-        else:  # else read data
-            data_start = trace_position + 20 + theader['num_ext_blocks'] * 32
-            data = read(fi, data_start, theader['samples'] * 4, '>f4')
-        traces.append(Trace(data=data, header=stats))
-        trace_position += jumps
-    if merge:
-        traces = quick_merge(traces)
-    return traces
-
-
-def _make_stats(theader, gheader):
-    """ make Stats object """
-    sampling_rate = int(1000. / (gheader['base_scan'] / 16.))
-
-    statsdict = dict(
-        starttime=UTCDateTime(theader['time'] / 1000000.),
-        sampling_rate=sampling_rate,
-        npts=theader['samples'],
-        network=str(theader['line_number']),
-        station=str(theader['point']),
-        location=str(theader['index']),
-        channel=str(theader['channel_code']),
+        positions.append(position)
+        position += length
+    return np.array(positions, dtype=np.int64)
+
+
+def _trace_length(theader):
+    """ return the number of bytes spanned by a trace and its headers """
+    samples = int(theader['samples'])
+    return int(theader['num_ext_blocks']) * 32 + samples * 4 + 20
+
+
+def _is_constant_length(theaders, first):
+    """ return True if all traces have the same shape as the first """
+    same_samples = np.all(theaders['samples'] == first['samples'])
+    same_ext = np.all(theaders['num_ext_blocks'] == first['num_ext_blocks'])
+    return bool(same_samples and same_ext)
+
+
+def _get_sampling_rate(gheader):
+    """ get the sampling rate from the base scan interval """
+    return int(1000. / (gheader['base_scan'] / 16.))
+
+
+def _iter_stats(theaders, sampling_rate):
+    """ yield a Stats object for each row of the trace header columns """
+    columns = zip(
+        theaders['time'].tolist(),
+        theaders['samples'].tolist(),
+        theaders['line_number'].tolist(),
+        theaders['point'].tolist(),
+        theaders['index'].tolist(),
+        theaders['channel_code'].tolist(),
     )
-    return Stats(statsdict)
+    # the seed ids rarely change within a file so build one template stats
+    # per id, then each trace only needs the starttime and npts set
+    templates = {}
+    for time, samples, line_number, point, index, channel_code in columns:
+        key = (line_number, point, index, channel_code)
+        if key not in templates:
+            statsdict = dict(
+                sampling_rate=sampling_rate,
+                network=str(line_number),
+                station=str(point),
+                location=str(index),
+                channel=str(channel_code),
+            )
+            templates[key] = Stats(statsdict)
+        stats = copy.copy(templates[key])
+        stats.starttime = UTCDateTime(ns=time * 1000)  # time is in us
+        stats.npts = samples
+        yield stats
 
 # Note: I am leaving this function in the code but comment as it may be needed
 # again in the future and contains some non-obvious info about the format
@@ -1,24 +1,68 @@
 """
 Utilities for fanopy
 """
-import collections
+import contextlib
 import copy
 import functools
+import io
+import mmap
+import os
 import struct
 
 import numpy as np
 from obspy import Trace
 
-BITMAP = np.array([1, 2, 4, 8])[::-1].reshape(4, 1)
+# the value (0 - 99) of each byte value read as two bcd digits, or 0xff if
+# either digit is invalid, so one translate both decodes and validates bcd
+BCD_BYTE = bytes((x >> 4) * 10 + (x & 0x0f) if x >> 4 < 10 and x & 0x0f < 10
+                 else 0xff for x in range(256))
+BCD_BYTE_ARRAY = np.frombuffer(BCD_BYTE, dtype=np.uint8)
 
-TENS = np.power(10, range(12))[::-1]
+# precompiled structs of signed big endian ints keyed by their data type,
+# and of the 4 byte unsigned ints 3 byte ints are unpacked from
+BIG_INTS = {dtype: struct.Struct('>' + code)
+            for dtype, code in (('>i1', 'b'), ('>i2', 'h'), ('>i4', 'i'),
+                                ('>i8', 'q'))}
+UINT32_BIG = struct.Struct('>I')
+UINT32_LITTLE = struct.Struct('<I')
+
+# types of the positions passed to read when backup positions are given
+SEQ_TYPES = (list, tuple, np.ndarray)
+
+# objects which can be sliced directly rather than seeked and read
+BUFFER_TYPES = (bytes, bytearray, memoryview, mmap.mmap)
+
+# opened files whose fileno holds the bytes they read, so can be mapped;
+# others (eg gzip.GzipFile) may decompress the file behind their fileno
+MAPPABLE_TYPES = (io.BufferedReader, io.BufferedRandom, io.FileIO)
+
+
+class InvalidBCDError(ValueError):
+    """
+    Raised when bytes are not valid binary coded decimals. The message is
+    only made if the error is formatted, as callers trying backup fields
+    usually discard it.
+    """
+
+    def __init__(self, byte_values=None):
+        super(InvalidBCDError, self).__init__(byte_values)
+        self.byte_values = byte_values
+
+    def __str__(self):
+        if self.byte_values is None:
+            return 'array contains invalid bcd values'
+        return '%s are not valid bcd values' % (self.byte_values,)
 
 
 def open_file(func):
     """
-    Decorator to ensure a file buffer is passed as first argument to the
+    Decorator to ensure a buffer is passed as first argument to the
     decorated function.
 
+    Paths and file objects are memory mapped (or read into memory if they
+    cannot be mapped) so the decorated function can slice bytes out of the
+    buffer rather than issuing a seek and read for every field.
+
     :param func:
         callable that takes at least one argument; the first argument must
         be treated as a buffer.
@@ -27,19 +71,94 @@ def open_file(func):
 
     @functools.wraps(func)
     def _wrap(*args, **kwargs):
-        first_arg = args[0]
-        try:
-            with open(first_arg, 'rb') as fi:
-                args = tuple([fi] + list(args[1:]))
-                return func(*args, **kwargs)
-        except TypeError:  # assume we have been passed a buffer
-            if not hasattr(args[0], 'read'):
-                raise  # type error was in function call, not in opening file
-            return func(*args, **kwargs)
+        with open_buffer(args[0]) as buf:
+            return func(buf, *args[1:], **kwargs)
 
     return _wrap
 
 
+@contextlib.contextmanager
+def open_buffer(fi, advise=False):
+    """
+    Context manager yielding a buffer of a path, file-like object or
+    buffer. Memory maps opened here are closed when the context exits.
+
+    :param fi: A path, file-like object, or buffer.
+    :param advise:
+        If True tell the kernel memory mapped files will be read start to
+        finish, only worth doing when the whole file is going to be read.
+    :type advise: bool
+    """
+    if isinstance(fi, BUFFER_TYPES):  # already a buffer
+        yield fi
+        return
+    if hasattr(fi, 'read'):  # an opened file-like object
+        with _map_file(fi, advise) as buf:
+            yield buf
+        return
+    with open(fi, 'rb') as opened, _map_file(opened, advise) as buf:
+        yield buf
+
+
+@contextlib.contextmanager
+def _map_file(fi, advise=False):
+    """
+    Yield a read-only memory map of an open file. In-memory files (eg
+    BytesIO) yield a view of their buffer instead, and anything else which
+    cannot be mapped (eg an empty or compressed file) yields its contents.
+    If advise the kernel is told the map will be read sequentially.
+    """
+    mm = None
+    if isinstance(fi, MAPPABLE_TYPES):
+        try:
+            mm = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # eg an empty file
+            pass
+    if mm is None:
+        if hasattr(fi, 'getbuffer'):
+            with _released(fi.getbuffer()) as view:
+                yield view
+        else:
+            fi.seek(0)
+            yield fi.read()
+        return
+    if advise:
+        _advise_sequential(fi, mm)
+    with _released(mm) as buf:
+        yield buf
+
+
+@contextlib.contextmanager
+def _released(buf):
+    """ yield a memory map or memoryview, closing or releasing it after """
+    try:
+        yield buf
+    finally:
+        try:
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+            else:
+                buf.release()
+        except BufferError:  # arrays still view the buffer, it goes with them
+            pass
+
+
+def _advise_sequential(fi, mm):
+    """
+    Tell the kernel a mapped file will be read start to finish so it reads
+    ahead aggressively. The hints are only available on some platforms
+    (eg Linux) and failing to give them is harmless.
+    """
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fi.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fi.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+    except OSError:
+        pass
+
+
 # -------------------- functions for byte chunk reads
 
 
@@ -54,18 +173,150 @@ def register_read_func(dtype):
     return _wrap
 
 
+# functions called as func(buf, position, length) which return the value
+# read, or None if the bytes can not be read as the data type, so backups
+# are tried without raising; data types without one can read any bytes
+READ_CHECKS = {}
+
+
+def register_read_check(dtype):
+    def _wrap(func):
+        READ_CHECKS[dtype] = func
+        return func
+
+    return _wrap
+
+
+# compiled readers of the specs passed to read_block
+COMPILED_BLOCKS = {}
+
+
 def read_block(fi, spec, start_bit=0):
+    """
+    Read the block described by spec into a dict of {name: value}.
+
+    The spec is compiled (see compile_block) the first time it is read and
+    the compiled reader reused after.
+    """
+    key = tuple(tuple(tuple(x) if isinstance(x, list) else x for x in field)
+                for field in spec)
+    if key not in COMPILED_BLOCKS:
+        COMPILED_BLOCKS[key] = compile_block(spec)
+    return COMPILED_BLOCKS[key](fi, start_bit)
+
+
+def compile_block(spec):
+    """
+    Compile a function which reads the block described by spec.
+
+    The returned function, called as f(fi, start_bit=0), returns a dict of
+    {name: value}. The positions, lengths and read functions of each field
+    are baked into its source so the spec is not walked, nor the formats
+    dispatched on, for every block read.
+
+    :param spec: The block specification, see rg16.core.
+    :return: callable
+    """
+    namespace = {'read_try_each': _read_try_each,
+                 'read_scalar': _read_scalar, 'buffer_at': buffer_at}
+    # get, or check there is, a buffer spanning all of the fields at once
+    end = max(_field_end(start, length) for _, start, length, _ in spec)
+    lines = ['def read_compiled_block(fi, start_bit=0):',
+             '    fi, start_bit = buffer_at(fi, start_bit, %d)' % end,
+             '    return {']
+    for index, (name, start, length, fmt) in enumerate(spec):
+        if isinstance(start, int) and fmt in READ_FUNCS:
+            func_name = '_read_%d' % index
+            namespace[func_name] = READ_FUNCS[fmt]
+            expr = '%s(fi, start_bit + %d, %d)' % (func_name, start, length)
+        elif isinstance(start, int):  # a numpy dtype
+            expr = 'read_scalar(fi, start_bit + %d, %d, %r)'
+            expr = expr % (start, length, fmt)
+        else:  # backup positions are tried in turn
+            positions = ', '.join('start_bit + %d' % x for x in start)
+            expr = 'read_try_each(fi, [%s], %r, %r)' % (positions, length, fmt)
+        lines.append('        %r: %s,' % (name, expr))
+    lines.append('    }')
+    exec('\n'.join(lines), namespace)
+    return namespace['read_compiled_block']
+
+
+def _field_end(start, length):
+    """ return the byte after the end of a field, or its last backup """
+    if isinstance(start, int):
+        return start + length
+    return max(x + y for x, y in zip(start, length))
+
+
+def read_block_array(buf, spec, positions):
+    """
+    Read the block described by spec at each of positions into arrays.
+
+    This is the vectorized version of read_block; rather than reading each
+    field of each block with separate read calls the blocks are viewed
+    with a structured dtype and each field is decoded as a column.
+
+    :param buf: A buffer (eg the memory map returned by open_file).
+    :param spec: The block specification, see rg16.core.
+    :param positions: The byte position of each block.
+    :type positions: sequence of ints
+    :return: A dict of {name: array} with one element per block.
+    """
+    dtype = block_dtype(spec)
+    positions = np.asarray(positions, dtype=np.int64)
+    steps = np.unique(np.diff(positions))
+    if len(positions) and len(steps) <= 1:
+        # evenly spaced blocks are viewed in place without copying
+        stride = int(steps[0]) if len(steps) else dtype.itemsize
+        blocks = np.ndarray(len(positions), dtype=dtype, buffer=buf,
+                            offset=int(positions[0]), strides=(stride,))
+    else:  # gather the bytes of each block
+        raw = np.frombuffer(buf, dtype=np.uint8)
+        index = positions[:, np.newaxis] + np.arange(dtype.itemsize)
+        blocks = raw[index].view(dtype).reshape(-1)
     out = {}
-    for name, start, length, fmt in spec:
-        out[name] = read(fi, start_bit + np.array(start), length, fmt)
+    for name, _, _, fmt in spec:
+        if fmt in READ_ARRAY_FUNCS:
+            out[name] = READ_ARRAY_FUNCS[fmt](blocks[name])
+        else:  # copy to native ints/floats so no views of buf are kept
+            column = blocks[name]
+            if column.dtype.kind in 'iu':
+                out[name] = column.astype(np.int64)
+            else:
+                out[name] = column.astype(column.dtype.newbyteorder('='))
     return out
 
 
+def is_bcd(byte_values):
+    """ return True if every half byte of byte_values is a valid bcd digit """
+    return b'\xff' not in bytes(byte_values).translate(BCD_BYTE)
+
+
+def block_dtype(spec):
+    """
+    Make a structured numpy dtype with fields at the offsets given in spec.
+
+    Formats numpy does not understand (bcd, 3 byte ints, etc.) are given
+    uint8 sub-arrays of the field length so they can be decoded later.
+    """
+    names, formats, offsets, ends = [], [], [], []
+    for name, start, length, fmt in spec:
+        if not isinstance(start, int):
+            msg = 'backup positions are not supported for array reads'
+            raise TypeError(msg)
+        names.append(name)
+        offsets.append(start)
+        ends.append(start + length)
+        formats.append(('u1', (length,)) if fmt in READ_ARRAY_FUNCS else fmt)
+    return np.dtype(dict(names=names, formats=formats, offsets=offsets,
+                         itemsize=max(ends)))
+
+
 def read(fi, position, length, dtype):
     """
     Read one or more bytes using provided datatype.
 
-    :param fi: A buffer containing the bytes to read.
+    :param fi: A buffer or file-like object containing the bytes to read.
     :param position: Byte position to start reading.
     :type position: int
     :param length: Length, in bytes, of data to read.
@@ -79,76 +330,259 @@ def read(fi, position, length, dtype):
     :type dtype: str
     :return:
     """
-    # if a list is passed as parameters then recurse through each
-    if isinstance(position, (collections.Sequence, np.ndarray)):
-        assert len(position) == len(length) == len(dtype)
-        for pos, leng, dty in zip(position, length, dtype):
-            try:
-                return read(fi, pos, leng, dty)
-            except ValueError:
-                pass
-        else:
-            msg = 'failed to read chunk'
+    # if a list is passed as parameters then try each in turn
+    if isinstance(position, SEQ_TYPES):
+        return _read_try_each(fi, position, length, dtype)
+    return _read_scalar(fi, position, length, dtype)
+
+
+def _read_try_each(fi, positions, lengths, dtypes):
+    """
+    Read each of positions, lengths and dtypes in turn and return the first
+    value which can be read. Raises a ValueError if none can.
+    """
+    assert len(positions) == len(lengths) == len(dtypes)
+    for pos, leng, dty in zip(positions, lengths, dtypes):
+        try:
+            buf, start = buffer_at(fi, pos, leng)
+        except ValueError:  # not enough bytes
+            continue
+        check = READ_CHECKS.get(dty)
+        if check is None:
+            return _read_scalar(buf, start, leng, dty)
+        value = check(buf, start, leng)
+        if value is not None:
+            return value
+    msg = 'failed to read chunk'
+    raise ValueError(msg)
+
+
+def _read_scalar(fi, position, length, dtype):
+    """ read a single field, see read """
+    fi, position = buffer_at(fi, position, length)
+    func = READ_FUNCS.get(dtype)
+    if func is None:  # any other numpy data type
+        return _read_numpy(fi, position, length, dtype)
+    return func(fi, position, length)
+
+
+def _read_numpy(buf, position, length, dtype):
+    """ read bytes as a numpy data type, returning a scalar for one value """
+    data = np.frombuffer(memoryview(buf)[position:position + length], dtype)
+    # copy arrays so they do not keep a view of the buffer
+    return data[0] if len(data) == 1 else data.copy()
+
+
+def read_struct(fi, position, fmt):
+    """
+    Read contiguous fixed width fields with a single struct unpack.
+
+    :param fi: A buffer or file-like object containing the bytes to read.
+    :param position: Byte position to start reading.
+    :type position: int
+    :param fmt: A struct format string, eg '>IIH'.
+    :type fmt: str
+    :return: tuple of the unpacked values
+    """
+    compiled = _compiled_struct(fmt)
+    fi, position = buffer_at(fi, position, compiled.size)
+    return compiled.unpack_from(fi, position)
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled_struct(fmt):
+    """ return a struct.Struct of fmt, compiled once per format """
+    return struct.Struct(fmt)
+
+
+def buffer_at(fi, position, length):
+    """
+    Return a buffer holding length bytes starting at position, and the
+    position of those bytes in it, so they can be read in place.
+
+    Buffers are returned as they are, after checking they are long enough;
+    file-like objects are seeked and read into a new buffer.
+    """
+    if isinstance(fi, BUFFER_TYPES):
+        if position + length > len(fi):
+            msg = 'could not read %d bytes at position %d' % (length, position)
             raise ValueError(msg)
-    # non recursive case
+        return fi, position
+    return _read_file_chunk(fi, position, length), 0
+
+
+def _read_file_chunk(fi, position, length):
+    """ seek a file-like object and read length bytes from position """
+    length = int(length)
     fi.seek(position)
-    if dtype in READ_FUNCS:
-        return READ_FUNCS[dtype](fi, length)
-    else:
-        data = np.fromstring(fi.read(int(length)), dtype)
-        return data[0] if len(data) == 1 else data
+    chunk = fi.read(length)
+    if len(chunk) < length:
+        msg = 'could not read %d bytes at position %d' % (length, position)
+        raise ValueError(msg)
+    return chunk
+
+
+# read functions are called as func(buf, position, length) and read the
+# bytes in place, rather than being passed a copy of the bytes
 
 
 @register_read_func('bcd')
-def read_bcd(fi, length):
+def read_bcd(buf, position, length):
     """
     Interprets a byte string as binary coded decimals. See:
     https://en.wikipedia.org/wiki/Binary-coded_decimal#Basics
 
     Raises a ValueError if any any invalid values are found.
     """
-    byte_values = fi.read(length)
-    ints = np.fromstring(byte_values, dtype='<u1', count=length)
-    bits = np.dot(np.unpackbits(ints).reshape(-1, 4), BITMAP)
-    if np.any(bits > 9):
-        raise ValueError('%s are not valid bcd values' % byte_values)
-    return np.dot(TENS[-len(bits):], bits)[0]
+    byte_values = bytes(buf[position:position + length])
+    pairs = byte_values.translate(BCD_BYTE)
+    if b'\xff' in pairs:
+        raise InvalidBCDError(byte_values)
+    return _bcd_pairs_value(pairs)
+
+
+@register_read_check('bcd')
+def check_bcd(buf, position, length):
+    """ read the bytes as binary coded decimals, None if they are invalid """
+    pairs = bytes(buf[position:position + length]).translate(BCD_BYTE)
+    if b'\xff' in pairs:
+        return None
+    return _bcd_pairs_value(pairs)
+
+
+def _bcd_pairs_value(pairs):
+    """ return the int of the digit pairs of valid bcd bytes """
+    # fields are only a few bytes long, too few to be worth calling numpy
+    value = 0
+    for pair in pairs:
+        value = value * 100 + pair
+    return value
 
 
 @register_read_func(None)
-def read_bytes(fi, length):
+def read_bytes(buf, position, length):
     """ simply read raw bytes """
-    return fi.read(length)
+    return bytes(buf[position:position + length])
 
 
 @register_read_func('<i3')
-def read_24_bit_little(fi, length):
+def read_24_bit_little(buf, position, length):
     """ read a 3 byte int, little endian """
-    chunk = fi.read(length)
-    return struct.unpack('<I', chunk + b'\x00')[0]
+    if position + 4 <= len(buf):  # unpack the next byte too, then drop it
+        return UINT32_LITTLE.unpack_from(buf, position)[0] & 0xffffff
+    return int.from_bytes(buf[position:position + 3], 'little')
 
 
 @register_read_func('>i3')
-def read_24_bit_big(fi, length):
+def read_24_bit_big(buf, position, length):
     """ read a 3 byte int, big endian """
-    chunk = fi.read(length)
-    return struct.unpack('>I', b'\x00' + chunk)[0]
+    if position:  # unpack the previous byte too, then drop it
+        return UINT32_BIG.unpack_from(buf, position - 1)[0] & 0xffffff
+    return int.from_bytes(buf[position:position + 3], 'big')
+
+
+def _register_big_int(dtype, compiled):
+    """ register a reader of dtype which unpacks single ints with compiled """
+
+    @register_read_func(dtype)
+    def read_big_int(buf, position, length):
+        """ read a signed, big endian int without making a numpy scalar """
+        if length != compiled.size:  # not one int, let numpy handle it
+            return _read_numpy(buf, position, length, dtype)
+        return compiled.unpack_from(buf, position)[0]
+
+    return read_big_int
+
+
+for _dtype, _compiled in BIG_INTS.items():
+    _register_big_int(_dtype, _compiled)
 
 
 @register_read_func('>i.')
-def read_4_bit_left(fi, length):
+def read_4_bit_left(buf, position, length):
     """ read the four bits on the left """
     assert length == 1, 'half byte reads only support 1 byte length'
-    ints = np.fromstring(fi.read(length), dtype='<u1')[0]
-    return np.bitwise_and(ints >> 4, 0x0f)
+    return buf[position] >> 4
 
 
 @register_read_func('<i.')
-def read_4_bit_right(fi, length):
+def read_4_bit_right(buf, position, length):
     """ read the four bits on the right """
     assert length == 1, 'half byte reads only support 1 byte length'
-    ints = np.fromstring(fi.read(length), dtype='<u1')[0]
-    return np.bitwise_and(ints, 0x0f)
+    return buf[position] & 0x0f
+
+
+# -------------------- functions for reading columns of byte chunks
+
+
+READ_ARRAY_FUNCS = {}
+
+
+def register_read_array_func(dtype):
+    def _wrap(func):
+        READ_ARRAY_FUNCS[dtype] = func
+        return func
+
+    return _wrap
+
+
+@register_read_array_func('bcd')
+def read_bcd_array(column):
+    """
+    Interprets each row of a 2D uint8 array as binary coded decimals.
+
+    Raises a ValueError if any invalid values are found.
+    """
+    values = bcd_vec(column)
+    out = np.zeros(len(column), dtype=np.int64)
+    for byte_values in values.T:  # most significant byte first
+        out = out * 100 + byte_values
+    return out
+
+
+def bcd_vec(u8):
+    """
+    Decode an array of bytes, each holding two binary coded decimal digits,
+    into an array of ints from 0 to 99.
+
+    Raises a ValueError if any invalid values are found.
+    """
+    values = BCD_BYTE_ARRAY[np.asarray(u8, dtype=np.uint8)]
+    if (values == 0xff).any():
+        raise InvalidBCDError()
+    return values.astype(np.int64)
+
+
+@register_read_array_func(None)
+def read_bytes_array(column):
+    """ simply copy the raw bytes """
+    return column.copy()
+
+
+@register_read_array_func('<i3')
+def read_24_bit_little_array(column):
+    """ read rows of 3 byte ints, little endian """
+    ints = column.astype(np.int64)
+    return ints[:, 0] | (ints[:, 1] << 8) | (ints[:, 2] << 16)
+
+
+@register_read_array_func('>i3')
+def read_24_bit_big_array(column):
+    """ read rows of 3 byte ints, big endian """
+    ints = column.astype(np.int64)
+    return (ints[:, 0] << 16) | (ints[:, 1] << 8) | ints[:, 2]
+
+
+@register_read_array_func('>i.')
+def read_4_bit_left_array(column):
+    """ read the four bits on the left of each row """
+    return column[:, 0].astype(np.int64) >> 4
+
+
+@register_read_array_func('<i.')
+def read_4_bit_right_array(column):
+    """ read the four bits on the right of each row """
+    return column[:, 0].astype(np.int64) & 0x0f
 
 
 # ---------------------- stream manipulation stuff
@@ -172,53 +606,106 @@ def quick_merge(traces, small_number=.000001):
     assert len({tr.data.dtype for tr in traces}) == 1
     sampling_rate = traces[0].stats.sampling_rate
     diff = 1. / sampling_rate + small_number
-    # get the array
-    ar, trace_ar = _trace_list_to_rec_array(traces)
+    # get the columns needed to sort and group the traces
+    count = len(traces)
+    # fixed width strings rather than objects so sorting stays in numpy
+    ids = np.array([tr.id for tr in traces], dtype=str)
+    starts = np.fromiter((tr.stats.starttime.timestamp for tr in traces),
+                         dtype=np.float64, count=count)
+    ends = np.fromiter((tr.stats.endtime.timestamp for tr in traces),
+                       dtype=np.float64, count=count)
+    # sort by id then starttime
+    order = np.lexsort((starts, ids))
     # get groups of traces that can be merged together
-    group = _get_trace_groups(ar, diff)
-    group_numbers = np.unique(group)
-    out = [None] * len(group_numbers)  # init output list
-    for index, gnum in enumerate(group_numbers):
-        # ar_to_merge = ar[group == gnum]
-        trace_ar_to_merge = trace_ar[group == gnum]
-        new_data = np.concatenate(trace_ar_to_merge['data'])
-        # get updated stats object
-        new_stats = copy.deepcopy(trace_ar_to_merge['stats'][0])
+    group = _get_trace_groups(ids[order], starts[order], ends[order], diff)
+    # the rows are sorted so each group is a run; slice between the run
+    # edges rather than masking the whole array once per group
+    boundaries = np.flatnonzero(np.diff(group)) + 1
+    edges = [0] + boundaries.tolist() + [len(group)]
+    order = order.tolist()
+    out = [None] * (len(edges) - 1)  # init output list
+    for index in range(len(out)):
+        group_order = order[edges[index]:edges[index + 1]]
+        traces_to_merge = [traces[x] for x in group_order]
+        new_data = _join_data([tr.data for tr in traces_to_merge])
+        # get updated stats object, a shallow copy is enough as only npts
+        # (and so endtime) changes
+        new_stats = copy.copy(traces_to_merge[0].stats)
         new_stats.npts = len(new_data)
-        out[index] = Trace(data=new_data, header=new_stats)
+        out[index] = make_trace(new_data, new_stats)
     return out
 
 
-def _trace_list_to_rec_array(traces):
+def iter_quick_merge(traces, small_number=.000001):
+    """
+    Merge contiguous traces from an iterable as they are produced.
+
+    Only the traces of the current contiguous run of each id are held;
+    when a trace starts after a gap the run before it is merged and
+    yielded. The remaining runs are yielded, sorted by id, once traces is
+    exhausted. The traces of each id must come in time order, as they do
+    in rg16 files.
+
+    :param traces: iterable of ObsPy :class:`~obspy.core.trace.Trace`
+        objects.
+    :param small_number: see quick_merge.
+    :return: generator of ObsPy :class:`~obspy.core.trace.Trace` objects.
+    """
+    runs = {}  # {id: [traces of the current contiguous run]}
+    for tr in traces:
+        run = runs.setdefault(tr.id, [])
+        if run:
+            start = tr.stats.starttime.timestamp
+            gap = start - run[-1].stats.endtime.timestamp
+            if abs(gap) > tr.stats.delta + small_number:
+                for merged in quick_merge(run, small_number=small_number):
+                    yield merged
+                run = runs[tr.id] = []
+        run.append(tr)
+    for key in sorted(runs):
+        for merged in quick_merge(runs[key], small_number=small_number):
+            yield merged
+
+
+def make_trace(data, stats):
+    """
+    Make a Trace which takes ownership of stats.
+
+    Trace.__init__ copies the header and builds a new Stats from it, which
+    is wasted when stats is already a new Stats object. Here the data and
+    stats are set directly; stats.npts should already be set, it is not
+    changed to match the data (so head only traces keep their npts).
+    """
+    tr = Trace.__new__(Trace)
+    tr.stats = stats
+    super(Trace, tr).__setattr__('data', data)
+    return tr
+
+
+def _join_data(arrays):
     """
-    return a recarray from the trace list. These are seperated into
-    two arrays due to a weird issue with numpy.sort returning and error
-    set.
+    Join a sequence of 1D arrays by copying each into a single preallocated
+    array, avoiding the temporaries np.concatenate makes of its inputs.
     """
-    # get the id, starttime, endtime into a recarray
-    dtype1 = [('id', object), ('starttime', float), ('endtime', float)]
-    dtype2 = [('data', object), ('stats', object)]
-    data1 = [(tr.id, tr.stats.starttime.timestamp, tr.stats.endtime.timestamp)
-             for tr in traces]
-    data2 = [(tr.data, tr.stats) for tr in traces]
-    ar1 = np.array(data1, dtype=dtype1)  # array of id, starttime, endtime
-    ar2 = np.array(data2, dtype=dtype2)  # array of data, stats objects
-    #
-    sort_index = np.argsort(ar1, order=['id', 'starttime'])
-    return ar1[sort_index], ar2[sort_index]
+    total = sum(len(data) for data in arrays)
+    out = np.empty(total, dtype=arrays[0].dtype)
+    position = 0
+    for data in arrays:
+        out[position:position + len(data)] = data
+        position += len(data)
+    return out
 
 
-def _get_trace_groups(ar, diff):
+def _get_trace_groups(ids, starts, ends, diff):
     """
     Return an array of ints where each element corresponds to a pre-merged
-    trace row. All trace rows with the same group number can be merged.
-    """
-    # get a bool of if ids are the same as the next row down
-    ids_different = np.ones(len(ar), dtype=bool)
-    ids_different[1:] = ar['id'][1:] != ar['id'][:-1]
-    # get bool of endtimes within one sample of starttime of next row
-    disjoint = np.zeros(len(ar), dtype=bool)
-    start_end_diffs = ar['starttime'][1:] - ar['endtime'][:-1]
-    disjoint[:-1] = np.abs(start_end_diffs) <= diff
-    # get groups (not disjoint, not different ids)
-    return np.cumsum(ids_different & disjoint)
+    trace row, given the sorted id, starttime and endtime columns. All
+    trace rows with the same group number can be merged.
+    """
+    # a new group starts at each row which does not have the same id as the
+    # previous row and start within one sample of its endtime
+    new_group = np.ones(len(ids), dtype=bool)
+    same_id = ids[1:] == ids[:-1]
+    close = np.abs(starts[1:] - ends[:-1]) <= diff
+    new_group[1:] = ~(same_id & close)
+    return np.cumsum(new_group) - 1
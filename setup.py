@@ -27,7 +27,8 @@ requirements = [
 ]
 
 test_requirements = [
-    'pytest'
+    'pytest',
+    'hypothesis',
 ]
 
 setup_requirements = []
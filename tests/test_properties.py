@@ -0,0 +1,54 @@
+"""
+property based tests for the readers of rg16.utils, these are slow so they
+only run when selected with pytest -m slow
+"""
+import unittest
+
+import pytest
+
+hypothesis = pytest.importorskip('hypothesis')
+from hypothesis import given, strategies as st  # noqa: E402
+
+from rg16.utils import read, read_block_array  # noqa: E402
+
+pytestmark = pytest.mark.slow
+
+
+def bcd_encode(value, length):
+    """ encode a positive int as length bytes of binary coded decimal """
+    return bytes.fromhex('%0*d' % (2 * length, value))
+
+
+class TestReadProperties(unittest.TestCase):
+    """
+    Tests that values encoded in the formats of the file format are read
+    back unchanged.
+    """
+
+    @given(st.integers(0, 10 ** 16 - 1))
+    def test_bcd_round_trip(self, value):
+        """ ensure bcd encoded ints are read back as the same int """
+        byte = bcd_encode(value, 8)
+        self.assertEqual(read(memoryview(byte), 0, 8, 'bcd'), value)
+
+    @given(st.lists(st.integers(0, 9999), min_size=1, max_size=50))
+    def test_bcd_column_round_trip(self, values):
+        """ ensure columns of bcd encoded ints are read back the same """
+        buf = b''.join(bcd_encode(x, 2) for x in values)
+        positions = [2 * x for x in range(len(values))]
+        out = read_block_array(buf, [('value', 0, 2, 'bcd')], positions)
+        self.assertEqual(out['value'].tolist(), values)
+
+    @given(st.integers(0, 2 ** 24 - 1), st.binary(max_size=2),
+           st.binary(max_size=2))
+    def test_3_byte_round_trip(self, value, before, after):
+        """ ensure 3 byte ints are read back the same whatever bytes are
+        around them """
+        for format, order in (('>i3', 'big'), ('<i3', 'little')):
+            buf = before + value.to_bytes(3, order) + after
+            out = read(memoryview(buf), len(before), 3, format)
+            self.assertEqual(out, value)
+
+
+if __name__ == '__main__':
+    unittest.main()
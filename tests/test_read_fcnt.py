@@ -2,13 +2,22 @@
 tests for reading fcnt files
 """
 import glob
+import gzip
 import io
+import mmap
+import shutil
+import tempfile
+import types
 import unittest
+from unittest import mock
 from os.path import join, dirname
 
+import numpy as np
 import obspy
 
-from rg16.core import read_rg16, is_rg16
+from rg16.core import (read_rg16, is_rg16, _iter_constant_length_data,
+                       _iter_variable_length_data)
+from rg16.utils import open_buffer
 
 TEST_FCNT_DIRECTORY = join(dirname(__file__), 'test_data', 'fcnt')
 FCNT_FILES = glob.glob(join(TEST_FCNT_DIRECTORY, '*'))
@@ -28,6 +37,23 @@ class TestIsRG16(unittest.TestCase):
         buff = io.BytesIO()
         self.assertFalse(is_rg16(buff))
 
+    def test_no_read_ahead(self):
+        """ ensure checking a file does not ask the kernel to read all of
+        it ahead, but reading it does """
+        with mock.patch('rg16.utils._advise_sequential') as advise:
+            self.assertTrue(is_rg16(FCNT_FILES[0]))
+            self.assertFalse(advise.called)
+            read_rg16(FCNT_FILES[0], headonly=True)
+            self.assertTrue(advise.called)
+
+    def test_other_version(self):
+        """ ensure a file with another format version is not rg16 """
+        with open(FCNT_FILES[0], 'rb') as fi:
+            head = bytearray(fi.read(44))
+        self.assertTrue(is_rg16(bytes(head)))
+        head[43] = 5
+        self.assertFalse(is_rg16(bytes(head)))
+
 
 class TestStream(unittest.TestCase):
     """ basic tests for stream """
@@ -68,6 +94,40 @@ class TestStream(unittest.TestCase):
             except Exception:
                 self.fail('failed to read from bytesIO')
 
+    def test_can_read_from_bytes(self):
+        """ ensure reading the raw bytes of a file gives the same stream """
+        for fcnt_file, fcnt_stream in zip(FCNT_FILES, FCNT_STREAMS):
+            with open(fcnt_file, 'rb') as fi:
+                st = read_rg16(fi.read())
+            self.assertEqual(st, fcnt_stream)
+
+    def test_can_read_from_mmap(self):
+        """ ensure reading a memory map of a file gives the same stream """
+        for fcnt_file, fcnt_stream in zip(FCNT_FILES, FCNT_STREAMS):
+            with open(fcnt_file, 'rb') as fi:
+                mm = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+            st = read_rg16(mm)
+            mm.close()  # the data must not be views of the map
+            self.assertEqual(st, fcnt_stream)
+
+    def test_can_read_from_gzip(self):
+        """ ensure a gzip file is read through its decompressed bytes, not
+        the compressed bytes of its fileno """
+        for fcnt_file, fcnt_stream in zip(FCNT_FILES, FCNT_STREAMS):
+            with tempfile.TemporaryDirectory() as temp_dir:
+                path = join(temp_dir, 'data.fcnt.gz')
+                with open(fcnt_file, 'rb') as fi, gzip.open(path, 'wb') as gz:
+                    shutil.copyfileobj(fi, gz)
+                with gzip.open(path, 'rb') as gz:
+                    self.assertTrue(is_rg16(gz))
+                    st = read_rg16(gz)
+            self.assertEqual(st, fcnt_stream)
+
+    def test_bad_type_raises(self):
+        """ ensure something which is not a path, file or buffer raises """
+        with self.assertRaises(TypeError):
+            read_rg16(1.5)
+
     def test_no_empty_streams(self):
         """
         There should be no empty streams. Related to issue #1
@@ -106,6 +166,152 @@ class TestStartTimeEndTime(unittest.TestCase):
             self.assertLess(start, tpoint)
             self.assertLess(tpoint, end)
 
+    def test_window_edges(self):
+        """ ensure traces ending at starttime or starting at endtime are
+        kept, using the times of their stats """
+        for fcnt_file, fcnt_stream in zip(FCNT_FILES, FCNT_STREAMS):
+            stats = fcnt_stream[1].stats
+            st = read_rg16(fcnt_file, starttime=stats.endtime)
+            expected = [tr for tr in fcnt_stream
+                        if tr.stats.endtime >= stats.endtime]
+            self.assertIn(fcnt_stream[1], expected)
+            self.assertEqual(st, obspy.Stream(traces=expected))
+            st = read_rg16(fcnt_file, endtime=stats.starttime)
+            expected = [tr for tr in fcnt_stream
+                        if tr.stats.starttime <= stats.starttime]
+            self.assertEqual(st, obspy.Stream(traces=expected))
+
+    def test_window_without_traces(self):
+        """ ensure a time window with no traces returns an empty stream """
+        t1, t2 = obspy.UTCDateTime(1990, 1, 1), obspy.UTCDateTime(1990, 1, 2)
+        for fcnt_file in FCNT_FILES:
+            st = read_rg16(fcnt_file, starttime=t1, endtime=t2)
+            self.assertEqual(len(st), 0)
+
+
+class TestTraceHeaders(unittest.TestCase):
+    def test_walking_headers_gives_same_stream(self):
+        """ ensure walking the trace headers one at a time finds the same
+        traces as assuming constant trace lengths """
+        for fcnt_file, fcnt_stream in zip(FCNT_FILES, FCNT_STREAMS):
+            with mock.patch('rg16.core._read_constant_length_headers',
+                            return_value=None):
+                st = read_rg16(fcnt_file)
+            self.assertEqual(st, fcnt_stream)
+
+
+class TestData(unittest.TestCase):
+    def test_small_chunks(self):
+        """ ensure converting a few traces at a time gives the same data """
+        for fcnt_file, fcnt_stream in zip(FCNT_FILES, FCNT_STREAMS):
+            with mock.patch('rg16.core.DATA_CHUNK_BYTES', 1):
+                st = read_rg16(fcnt_file)
+            self.assertEqual(st, fcnt_stream)
+
+    def test_generator_traces_own_data(self):
+        """ ensure each trace from the generator has its own data array,
+        while the traces of a stream view the chunk they were converted
+        in """
+        for fcnt_file, fcnt_stream in zip(FCNT_FILES, FCNT_STREAMS):
+            traces = list(read_rg16(fcnt_file, generator=True))
+            for tr in traces:
+                self.assertTrue(tr.data.flags.owndata)
+            self.assertEqual(obspy.Stream(traces=traces), fcnt_stream)
+            for tr in fcnt_stream:
+                self.assertFalse(tr.data.flags.owndata)
+
+    def test_no_samples(self):
+        """ ensure equal length traces without samples give empty data """
+        data = list(_iter_constant_length_data(bytes(100), np.array([10, 30]),
+                                               0))
+        self.assertEqual(len(data), 2)
+        for array in data:
+            self.assertEqual(len(array), 0)
+            self.assertEqual(array.dtype, np.float32)
+
+    def test_threads(self):
+        """ ensure converting chunks in several threads gives the same
+        data """
+        for fcnt_file, fcnt_stream in zip(FCNT_FILES, FCNT_STREAMS):
+            threads = mock.patch('rg16.core.DATA_THREADS', 3)
+            with threads, mock.patch('rg16.core.DATA_CHUNK_BYTES', 1000):
+                st = read_rg16(fcnt_file)
+            self.assertEqual(st, fcnt_stream)
+
+    def test_variable_length_data(self):
+        """ ensure the data of traces with varying lengths are read the same
+        as traces of equal length """
+        def read_as_variable(fi, data_starts, samples, copy=False):
+            samples = np.full(len(data_starts), samples)
+            return _iter_variable_length_data(fi, data_starts, samples,
+                                              copy)
+
+        for fcnt_file, fcnt_stream in zip(FCNT_FILES, FCNT_STREAMS):
+            patch = mock.patch('rg16.core._iter_constant_length_data',
+                               read_as_variable)
+            threads = mock.patch('rg16.core.DATA_THREADS', 3)
+            chunks = mock.patch('rg16.core.DATA_CHUNK_BYTES', 5000)
+            with patch, threads, chunks:
+                st = read_rg16(fcnt_file)
+                traces = list(read_rg16(fcnt_file, generator=True))
+            self.assertEqual(st, fcnt_stream)
+            self.assertEqual(obspy.Stream(traces=traces), fcnt_stream)
+            for tr in traces:
+                self.assertTrue(tr.data.flags.owndata)
+
+    def test_uneven_traces(self):
+        """ ensure traces of different lengths with different gaps between
+        them are each read from their own bytes """
+        samples = np.array([3, 0, 5, 1, 4])
+        gaps = [20, 52, 20, 84, 20]  # header bytes before each trace
+        buf = bytearray()
+        data_starts = []
+        for count, gap in zip(samples.tolist(), gaps):
+            buf += b'\xff' * gap
+            data_starts.append(len(buf))
+            buf += (np.arange(count) + len(buf)).astype('>f4').tobytes()
+        data_starts = np.array(data_starts)
+        for chunk_bytes, copy in ((1, False), (12, True), (1000, False)):
+            with mock.patch('rg16.core.DATA_CHUNK_BYTES', chunk_bytes):
+                out = list(_iter_variable_length_data(bytes(buf), data_starts,
+                                                      samples, copy))
+            self.assertEqual(len(out), len(samples))
+            for array, start, count in zip(out, data_starts, samples):
+                expected = np.arange(count) + start
+                self.assertEqual(array.dtype, np.float32)
+                self.assertEqual(array.tolist(), expected.tolist())
+
+
+class TestGenerator(unittest.TestCase):
+    def test_generator_yields_stream_traces(self):
+        """ ensure the generator option yields the same traces """
+        for fcnt_file, fcnt_stream in zip(FCNT_FILES, FCNT_STREAMS):
+            traces = read_rg16(fcnt_file, generator=True)
+            self.assertIsInstance(traces, types.GeneratorType)
+            self.assertEqual(obspy.Stream(traces=list(traces)), fcnt_stream)
+
+    def test_generator_merge(self):
+        """ ensure merging traces from the generator gives the same traces
+        as the merge option """
+        for fcnt_file in FCNT_FILES:
+            traces = read_rg16(fcnt_file, generator=True, merge=True)
+            st = obspy.Stream(traces=list(traces)).sort()
+            self.assertEqual(st, read_rg16(fcnt_file, merge=True).sort())
+
+    def test_not_rg16_raises(self):
+        """ ensure a bad file raises before iterating """
+        with self.assertRaises(ValueError):
+            read_rg16(io.BytesIO(b'not rg16'), generator=True)
+
+    def test_file_checked_once(self):
+        """ ensure the file is only opened and checked once """
+        check = mock.patch('rg16.core.is_rg16', wraps=is_rg16)
+        opener = mock.patch('rg16.core.open_buffer', wraps=open_buffer)
+        with check as checked, opener as opened:
+            list(read_rg16(FCNT_FILES[0], generator=True))
+        self.assertEqual(checked.call_count, 1)
+        self.assertEqual(opened.call_count, 1)
+
 
 class TestMerge(unittest.TestCase):
     def test_merge(self):
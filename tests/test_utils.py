@@ -1,10 +1,20 @@
 """
 tests for the Utilities of rg16
 """
+import functools
+import mmap
+import tempfile
 import unittest
 from io import BytesIO
+from itertools import product
+from unittest import mock
 
-from rg16.utils import read
+import numpy as np
+import obspy
+
+from rg16.utils import (read, read_block, read_struct, read_block_array,
+                        compile_block, quick_merge, iter_quick_merge,
+                        make_trace, InvalidBCDError, _get_trace_groups)
 
 
 def byte_io(byte_str):
@@ -12,6 +22,27 @@ def byte_io(byte_str):
     return BytesIO(byte_str)
 
 
+def byte_mv(byte_str):
+    """ return a memoryview of byte_str, which is sliced rather than read """
+    return memoryview(byte_str)
+
+
+@functools.lru_cache(maxsize=None)
+def byte_mm(byte_str):
+    """
+    Return a read only memory map of a temporary file of byte_str. Maps are
+    made once per byte_str as read does not change them.
+    """
+    with tempfile.TemporaryFile() as fi:
+        fi.write(byte_str)
+        fi.flush()
+        return mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# file-like objects and buffers take different paths through read
+BYTE_WRAPPERS = (byte_io, byte_mv, byte_mm)
+
+
 class TestRead(unittest.TestCase):
     """
     Tests for the read function, which should read all the weird binary
@@ -23,21 +54,28 @@ class TestRead(unittest.TestCase):
     bcd = [
         (b'\x99', 1, 99),
         (b'\x99\x01', 2, 9901),
+        (b'\x12\x34\x56', 3, 123456),
     ]
 
     def test_read_bcd(self):
         """ ensure bcd encoding returns expected values """
-        for byte, length, answer in self.bcd:
-            out = read(byte_io(byte), 0, length, 'bcd')
+        for (byte, length, answer), wrap in product(self.bcd, BYTE_WRAPPERS):
+            out = read(wrap(byte), 0, length, 'bcd')
             self.assertEqual(out, answer)
 
     def test_ff_raises(self):
         """ ensure FF raises. BCD values for any half byte past 9 should
         raise """
-        with self.assertRaises(ValueError) as e:
+        with self.assertRaises(InvalidBCDError) as e:
             read(byte_io(b'\xFF'), 0, 1, 'bcd')
+        self.assertIsInstance(e.exception, ValueError)
         assert 'are not valid bcd' in str(e.exception)
 
+    def test_invalid_low_digit_raises(self):
+        """ ensure an invalid right half byte raises too """
+        with self.assertRaises(InvalidBCDError):
+            read(byte_io(b'\x12\x1a'), 0, 2, 'bcd')
+
     # --- test half byte reads
 
     halfsies = [
@@ -49,8 +87,9 @@ class TestRead(unittest.TestCase):
 
     def test_read_half_bit(self):
         """ ensure reading half bytes (4 bit) works """
-        for byte, format, answer in self.halfsies:
-            self.assertEqual(read(byte_io(byte), 0, 1, format), answer)
+        for (byte, format, answer), wrap in product(self.halfsies,
+                                                    BYTE_WRAPPERS):
+            self.assertEqual(read(wrap(byte), 0, 1, format), answer)
 
     # --- test 24 bit (3 byte) reads
 
@@ -63,8 +102,78 @@ class TestRead(unittest.TestCase):
 
     def test_read_3_bytes(self):
         """ ensure 3 byte chunks are correctly read """
-        for byte, format, answer in self.why_use_3_bytes:
-            self.assertEqual(read(byte_io(byte), 0, 3, format), answer)
+        for (byte, format, answer), wrap in product(self.why_use_3_bytes,
+                                                    BYTE_WRAPPERS):
+            self.assertEqual(read(wrap(byte), 0, 3, format), answer)
+
+    def test_read_3_bytes_inside_buffer(self):
+        """ ensure 3 byte ints with bytes on both sides are read without
+        the neighbouring bytes """
+        for (byte, format, answer), wrap in product(self.why_use_3_bytes,
+                                                    BYTE_WRAPPERS):
+            padded = wrap(b'\xff' + byte + b'\xff')
+            self.assertEqual(read(padded, 1, 3, format), answer)
+
+    # --- test big endian ints
+
+    big_ints = [
+        (b'\xff', '>i1', -1),
+        (b'\x01\x00', '>i2', 256),
+        (b'\xff\xff\xff\xfe', '>i4', -2),
+        (b'\x00\x00\x00\x00\x00\x00\x01\x01', '>i8', 257),
+    ]
+
+    def test_read_big_ints(self):
+        """ ensure big endian ints are read as python ints """
+        for (byte, format, answer), wrap in product(self.big_ints,
+                                                    BYTE_WRAPPERS):
+            out = read(wrap(byte), 0, len(byte), format)
+            self.assertEqual(out, answer)
+            self.assertIsInstance(out, int)
+            self.assertEqual(out, np.frombuffer(byte, format)[0])
+
+    def test_read_big_int_arrays(self):
+        """ ensure big endian int fields longer than one int are read as
+        arrays, and lengths which are not whole ints raise ValueError """
+        byte = b'\x00\x01\x00\x02'
+        for wrap in BYTE_WRAPPERS:
+            out = read(wrap(byte), 0, 4, '>i2')
+            self.assertEqual(out.tolist(), [1, 2])
+            out = read(wrap(byte), 0, 2, '>i1')
+            self.assertEqual(out.tolist(), [0, 1])
+            with self.assertRaises(ValueError):
+                read(wrap(byte), 0, 3, '>i2')
+
+    def test_short_buffer_raises(self):
+        """ ensure reading past the end of a buffer raises rather than
+        reading fewer bytes """
+        for buf in (b'\x01', bytearray(b'\x01'), memoryview(b'\x01')):
+            with self.assertRaises(ValueError):
+                read(buf, 0, 2, '>i2')
+
+    # --- test all cases from one buffer
+
+    def test_read_packed(self):
+        """ ensure every case reads the same when all the cases are packed
+        into one buffer and read at their offsets """
+        cases = ([(byte, 'bcd', answer) for byte, _, answer in self.bcd] +
+                 self.halfsies + self.why_use_3_bytes + self.big_ints)
+        offsets = np.cumsum([0] + [len(x[0]) for x in cases]).tolist()
+        packed = memoryview(b''.join(x[0] for x in cases))
+        for (byte, format, answer), offset in zip(cases, offsets):
+            out = read(packed, offset, len(byte), format)
+            self.assertEqual(out, answer)
+
+    # --- test struct reads
+
+    def test_read_struct(self):
+        """ ensure contiguous fields are read with one struct format """
+        byte = b'\x00\x00\x00\x01\xff\xfe\x07'
+        for wrap in BYTE_WRAPPERS:
+            self.assertEqual(read_struct(wrap(byte), 0, '>Ih'), (1, -2))
+            self.assertEqual(read_struct(wrap(byte), 4, '>Hb'), (65534, 7))
+            with self.assertRaises(ValueError):
+                read_struct(wrap(byte), 4, '>I')
 
     # --- test backup
 
@@ -74,12 +183,170 @@ class TestRead(unittest.TestCase):
         fi = byte_io(b'\xff\x98')
         self.assertEqual(read(fi, [0, 1], [1, 1], ['bcd', 'bcd']), 98)
 
+    def test_backup_decoded_once(self):
+        """ ensure a valid bcd backup is decoded by its check rather than
+        being validated and decoded again by the read function """
+        fi = byte_mv(b'\xff\x98')
+        funcs = mock.patch.dict('rg16.utils.READ_FUNCS', {'bcd': None})
+        with funcs:
+            self.assertEqual(read(fi, [0, 1], [1, 1], ['bcd', 'bcd']), 98)
+
     def test_read_raises_when_all_fail(self):
         """ensure the backup function raises if it runs off the edge """
         fi = byte_io(b'\xff\xff')
         with self.assertRaises(ValueError):
             read(fi, [0, 1], [1, 1], ['bcd', 'bcd'])
 
+    def test_backup_past_end(self):
+        """ ensure a backup position past the end of the bytes is skipped
+        and the next one read """
+        fi = byte_mv(b'\xff\x98')
+        self.assertEqual(read(fi, [0, 5, 1], [1, 1, 1], ['bcd'] * 3), 98)
+
+
+class TestReadBlockArray(unittest.TestCase):
+    """
+    Tests for reading many blocks at once, which should give the same
+    values as reading each block with read_block.
+    """
+    spec = [
+        ('bcd', 0, 2, 'bcd'),
+        ('big3', 2, 3, '>i3'),
+        ('little3', 2, 3, '<i3'),
+        ('left', 5, 1, '>i.'),
+        ('right', 5, 1, '<i.'),
+        ('int4', 6, 4, '>i4'),
+    ]
+    blocks = [
+        b'\x12\x34\x00\x01\x02\x4a\xff\xff\xff\xfe--',
+        b'\x99\x01\x10\x00\x00\xf0\x00\x00\x01\x00--',
+        b'\x00\x00\xff\xff\xff\x01\x7f\xff\xff\xff--',
+    ]
+
+    def test_matches_read_block(self):
+        """ ensure each column matches the values from read_block """
+        buf = b'header' + b''.join(self.blocks)
+        stride = len(self.blocks[0])
+        positions = [6 + x * stride for x in range(len(self.blocks))]
+        for positions in [positions, positions[::-1]]:
+            out = read_block_array(buf, self.spec, positions)
+            for index, position in enumerate(positions):
+                expected = read_block(buf, self.spec, position)
+                for name, value in expected.items():
+                    self.assertEqual(out[name][index], value)
+
+    def test_unevenly_spaced(self):
+        """ ensure blocks which are not evenly spaced can be read """
+        buf = b''.join(self.blocks)
+        out = read_block_array(buf, self.spec, [0, 3, 12])
+        for index, position in enumerate([0, 3, 12]):
+            self.assertEqual(out['big3'][index],
+                             read(buf, position + 2, 3, '>i3'))
+
+    def test_invalid_bcd_raises(self):
+        """ ensure invalid bcd in any block raises """
+        buf = self.blocks[0] + b'\xff' + self.blocks[1][1:]
+        with self.assertRaises(InvalidBCDError):
+            read_block_array(buf, self.spec[:1], [0, len(self.blocks[0])])
+
+
+class TestCompileBlock(unittest.TestCase):
+    """
+    Tests for compiled block readers, which should give the same values
+    as reading each field.
+    """
+    spec = TestReadBlockArray.spec + [
+        ('backup', [6, 0], [1, 1], ['bcd', 'bcd']),  # 6 is not bcd
+        ('raw', 10, 2, None),
+    ]
+
+    def read_fields(self, fi, position=0):
+        """ read each field of the spec on its own """
+        return {name: read(fi, position + np.array(start), length, fmt)
+                for name, start, length, fmt in self.spec}
+
+    def test_matches_reading_fields(self):
+        """ ensure compiled readers match reading each field at any
+        position """
+        buf = b''.join(TestReadBlockArray.blocks)
+        read_compiled = compile_block(self.spec)
+        for position in (0, 12, 24):
+            expected = self.read_fields(buf, position)
+            self.assertEqual(read_compiled(buf, position), expected)
+            self.assertEqual(read_block(buf, self.spec, position), expected)
+        # and file-like objects are also supported
+        self.assertEqual(read_compiled(byte_io(buf)),
+                         self.read_fields(byte_io(buf)))
+
+    def test_file_like_read_once(self):
+        """ ensure a block is read from a file-like object with one read
+        and then parsed from memory """
+        fi = byte_io(b''.join(TestReadBlockArray.blocks))
+        with mock.patch.object(fi, 'read', wraps=fi.read) as read_mock:
+            read_block(fi, self.spec)
+        self.assertEqual(read_mock.call_count, 1)
+
+
+class TestQuickMerge(unittest.TestCase):
+    """
+    Tests for merging traces, only contiguous traces with the same id
+    should be merged.
+    """
+
+    def make_trace(self, starttime, station='1', npts=10):
+        """ make a trace with one sample per second """
+        header = dict(starttime=obspy.UTCDateTime(starttime), npts=npts,
+                      sampling_rate=1., station=station)
+        return obspy.Trace(data=np.arange(npts, dtype=np.float32),
+                           header=header)
+
+    def test_contiguous_merged(self):
+        """ ensure contiguous traces are merged into one """
+        traces = [self.make_trace(x) for x in (20, 0, 10)]
+        out = quick_merge(traces)
+        self.assertEqual(len(out), 1)
+        self.assertEqual(out[0].stats.npts, 30)
+        self.assertEqual(out[0].stats.starttime, obspy.UTCDateTime(0))
+
+    def test_gaps_not_merged(self):
+        """ ensure traces separated by a gap are not merged """
+        traces = [self.make_trace(x) for x in (0, 10, 100, 110)]
+        out = quick_merge(traces)
+        self.assertEqual([tr.stats.npts for tr in out], [20, 20])
+
+    def test_ids_not_merged(self):
+        """ ensure traces with different ids are not merged """
+        traces = [self.make_trace(0, 'A'), self.make_trace(10, 'B')]
+        out = quick_merge(traces)
+        self.assertEqual({tr.id for tr in out}, {'.A..', '.B..'})
+
+    def test_trace_groups(self):
+        """ ensure group numbers start at 0 and change at each new id or
+        gap """
+        ids = np.array(['A', 'A', 'A', 'B', 'B'])
+        starts = np.array([0., 10., 100., 110., 120.])
+        groups = _get_trace_groups(ids, starts, starts + 9, 1.000001)
+        self.assertEqual(groups.tolist(), [0, 0, 1, 2, 2])
+
+    def test_iter_matches_quick_merge(self):
+        """ ensure merging traces as they come gives the same traces """
+        traces = [self.make_trace(x, y) for x in (0, 10, 100, 110, 120)
+                  for y in 'BA']
+        out = list(iter_quick_merge(iter(traces)))
+        expected = quick_merge(traces)
+        self.assertEqual(sorted(out, key=str), sorted(expected, key=str))
+
+
+class TestMakeTrace(unittest.TestCase):
+    def test_matches_trace(self):
+        """ ensure make_trace gives the same trace as Trace """
+        data = np.arange(10, dtype=np.float32)
+        stats = obspy.core.Stats(dict(station='A', sampling_rate=10.,
+                                      npts=10))
+        expected = obspy.Trace(data=data, header=stats)
+        self.assertEqual(make_trace(data, stats), expected)
+        self.assertIsInstance(make_trace(data, stats), obspy.Trace)
+
 
 if __name__ == '__main__':
     unittest.main()